@@ -1,12 +1,104 @@
-import argparse
-from pathlib import Path
 import sys
+import os
+import stat
+import re
+import binascii
+import functools
 import json
+import struct
 import hashlib
 import zlib
-from typing import Dict, List, Tuple
+import mmap
+from collections import OrderedDict
+from itertools import chain, repeat
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Tuple
 import time
 
+# libdeflate compresses one-shot buffers much faster than zlib; fall back
+# to plain zlib when it is missing
+try:
+    from deflate import deflate_compress as libdeflate_compress
+except ImportError:
+    libdeflate_compress = None
+# libdeflate level 4 matches the ratio of zlib's default level 6
+LIBDEFLATE_LEVEL = 4
+ZLIB_LEVEL = 6
+
+# size of the slices fed to the compressor when streaming file contents
+CHUNK_SIZE = 1 << 20
+# below this many files (or with one CPU) a process pool costs more to
+# start than it saves
+PARALLEL_ADD_THRESHOLD = 64
+# reader threads and queue depth used by Repository.bulk_store_blobs
+BULK_READERS = 4
+BULK_QUEUE_SIZE = 64
+# read/write buffer used when streaming blobs out of the object store
+STREAM_BUFFER_SIZE = 64 * 1024
+# loaded-object LRU cache: entry count and largest object size kept
+OBJECT_CACHE_SIZE = 1024
+OBJECT_CACHE_MAX_OBJECT = 64 * 1024
+
+# binary index layout: magic + entry count, then per entry a fixed record
+# (path length, raw sha1, mtime_ns, ctime_ns, size, inode) followed by the
+# utf-8 path; times are signed since files may predate 1970
+INDEX_MAGIC = b"GPI2"
+INDEX_HEADER = struct.Struct('<4sI')
+INDEX_ENTRY = struct.Struct('<H20sqqQQ')
+INDEX_FIELDS = ("mtime_ns", "ctime_ns", "size", "ino")
+# the first binary format, still read: no ctime_ns
+INDEX_MAGIC_V1 = b"GPIX"
+INDEX_ENTRY_V1 = struct.Struct('<H20sqQQ')
+INDEX_FIELDS_V1 = ("mtime_ns", "size", "ino")
+# persistent blob hash cache: magic, then fixed records of
+# (blake2b path key, inode, signed mtime_ns, signed ctime_ns, size, raw sha1);
+# caches from before the magic was added are discarded
+HASHCACHE_MAGIC = b"GPH2"
+HASHCACHE_ENTRY = struct.Struct('<QQqqQ20s')
+
+# Objects are stored as this marker followed by raw DEFLATE. The SHA-1 name
+# already covers the content, so zlib's header and Adler-32 trailer are
+# dropped. The marker can never start a zlib stream (its compression method
+# nibble is not 8), so objects written as plain zlib are still read.
+RAW_OBJECT_MAGIC = b"GP"
+
+
+# ==============================================
+# Object Encoding
+# ==============================================
+_SMALL_BLOB_HEADERS = [f"blob {n}\0".encode() for n in range(1024)]
+
+
+def object_header(obj_type: str, size: int) -> bytes:
+    if obj_type == 'blob' and size < len(_SMALL_BLOB_HEADERS):
+        return _SMALL_BLOB_HEADERS[size]
+    return f"{obj_type} {size}\0".encode()
+
+
+def new_compressor(level: int = ZLIB_LEVEL):
+    return zlib.compressobj(level, zlib.DEFLATED, -15)
+
+
+def compress_object(header: bytes, content: bytes) -> bytes:
+    # whole-buffer compression of an object held in memory
+    if libdeflate_compress is not None:
+        return RAW_OBJECT_MAGIC + libdeflate_compress(header + content, LIBDEFLATE_LEVEL)
+    compressor = new_compressor()
+    return (RAW_OBJECT_MAGIC + compressor.compress(header)
+            + compressor.compress(content) + compressor.flush())
+
+
+def object_decompressor(prefix: bytes):
+    # returns the decompressor for a stored object and how many leading bytes to skip
+    if prefix.startswith(RAW_OBJECT_MAGIC):
+        return zlib.decompressobj(-15), len(RAW_OBJECT_MAGIC)
+    return zlib.decompressobj(), 0
+
+
+def decompress_object(data: bytes) -> bytes:
+    decompressor, skip = object_decompressor(data)
+    return decompressor.decompress(memoryview(data)[skip:]) + decompressor.flush()
+
 
 # ==============================================
 # Base Git Object Class
@@ -17,16 +109,19 @@ class GitObject:
         self.content = content
 
     def hash(self):
-        header = f"{self.type} {len(self.content)}\0".encode()
-        return hashlib.sha1(header + self.content).hexdigest()
+        # feed header and content separately so the content is never copied
+        header = object_header(self.type, len(self.content))
+        h = hashlib.sha1()
+        h.update(header)
+        h.update(self.content)
+        return h.hexdigest()
 
     def serialize(self) -> bytes:
-        header = f"{self.type} {len(self.content)}\0".encode()
-        return zlib.compress(header + self.content)
+        return compress_object(object_header(self.type, len(self.content)), self.content)
 
     @classmethod
     def deserialize(cls, data: bytes) -> 'GitObject':
-        decompressed = zlib.decompress(data)
+        decompressed = decompress_object(data)
         null_idx = decompressed.find(b'\0')
         header = decompressed[:null_idx]
         content = decompressed[null_idx + 1:]
@@ -34,6 +129,29 @@ class GitObject:
         return cls(obj_type.decode(), content)
 
 
+class _LazyObject(GitObject):
+    # Object loaded from disk that only inflates the header up front;
+    # the content is decompressed on first access and then cached.
+    def __init__(self, raw: bytes) -> None:
+        self._raw = raw
+        self._content = None
+        decompressor, skip = object_decompressor(raw)
+        prefix = decompressor.decompress(memoryview(raw)[skip:], 64)
+        while b'\0' not in prefix and decompressor.unconsumed_tail:
+            prefix += decompressor.decompress(decompressor.unconsumed_tail, 64)
+        obj_type, size = prefix[:prefix.find(b'\0')].split(b' ')
+        self.type = obj_type.decode()
+        self.size = int(size)
+
+    @property
+    def content(self) -> bytes:
+        if self._content is None:
+            decompressed = decompress_object(self._raw)
+            self._content = decompressed[decompressed.find(b'\0') + 1:]
+            self._raw = None
+        return self._content
+
+
 # ==============================================
 # Blob Object
 # ==============================================
@@ -48,41 +166,58 @@ class Blob(GitObject):
 # ==============================================
 # Tree Object
 # ==============================================
+# "<mode> <name>\0<20-byte sha1>" repeated for every entry
+_TREE_ENTRY_RE = re.compile(rb'(\d+) ([^\x00]+)\x00(.{20})', re.DOTALL)
+
+
 class Tree(GitObject):
     def __init__(self, entries: List[Tuple[str, str, str]] = None) -> None:
         self.entries = entries or []
         content = self._serialize_entries()
         super().__init__('tree', content)
 
-    def _serialize_entries(self) -> bytes:
-        result = b''
-        for mode, name, hash in self.entries:
-            result += f"{mode} {name}\0".encode() + bytes.fromhex(hash)
-        return result
+    @staticmethod
+    def _encode_entry(mode: str, name: str, hash: str) -> bytes:
+        return f"{mode} {name}\0".encode() + bytes.fromhex(hash)
+
+    def _serialize_entries(self) -> bytearray:
+        # full rebuild; add_entry appends instead of calling this
+        headers = [f"{mode} {name}\0".encode() for mode, name, _ in self.entries]
+        raw_hashes = binascii.unhexlify(''.join([hash for _, _, hash in self.entries]))
+        # joining into a bytearray avoids copying the joined bytes a second time
+        return bytearray().join([headers[i] + raw_hashes[i * 20:(i + 1) * 20]
+                                 for i in range(len(headers))])
 
     def add_entry(self, mode: str, name: str, hash: str):
         self.entries.append((mode, name, hash))
-        self.content = self._serialize_entries()
+        if not isinstance(self.content, bytearray):
+            # parsed trees keep the bytes they were given until first modified
+            self.content = bytearray(self.content)
+        self.content += self._encode_entry(mode, name, hash)
 
     @classmethod
-    def from_content(cls, data: bytes) -> 'Tree':
-        tree = cls()
-        i = 0
-        while i < len(data):
-            null_idx = data.find(b'\0', i)
-            if null_idx == -1:
-                break
-            mode_name = data[i:null_idx].decode()
-            mode, name = mode_name.split(' ', 1)
-            obj_hash = data[null_idx + 1: null_idx + 21].hex()
-            tree.add_entry(mode, name, obj_hash)
-            i = null_idx + 21
+    def _from_parsed(cls, entries: List[Tuple[str, str, str]], content: bytes) -> 'Tree':
+        # build a tree whose serialized form is already known
+        tree = cls.__new__(cls)
+        tree.entries = entries
+        GitObject.__init__(tree, 'tree', content)
         return tree
 
+    @classmethod
+    def from_content(cls, data: bytes) -> 'Tree':
+        matches = list(_TREE_ENTRY_RE.finditer(data))
+        hex_hashes = binascii.hexlify(b''.join([m.group(3) for m in matches])).decode()
+        entries = [(m.group(1).decode(), m.group(2).decode(), hex_hashes[i * 40:(i + 1) * 40])
+                   for i, m in enumerate(matches)]
+        return cls._from_parsed(entries, data)
+
 
 # ==============================================
 # Commit Object
 # ==============================================
+_COMMIT_HEADER_RE = re.compile(rb'^(tree|parent|author|committer) (.*)$', re.MULTILINE)
+
+
 class Commit(GitObject):
     def __init__(self,
                  tree_hash: str,
@@ -115,25 +250,26 @@ class Commit(GitObject):
 
     @classmethod
     def from_content(cls, data: bytes) -> 'Commit':
-        lines = data.decode().split('\n')
+        # only the header lines are scanned; the message is decoded once as a whole
+        header_end = data.find(b'\n\n')
+        if header_end == -1:
+            header, message = data, data.decode()
+        else:
+            header, message = data[:header_end], data[header_end + 2:].decode()
         tree_hash = None
         parent_hashes = []
         author = None
         committer = None
-        message_start = 0
-        for i, line in enumerate(lines):
-            if line.startswith("tree "):
-                tree_hash = line[5:]
-            elif line.startswith("parent "):
-                parent_hashes.append(line[7:])
-            elif line.startswith("author "):
-                author = line[7:].rsplit(' ', 2)[0]
-            elif line.startswith("committer "):
-                committer = line[10:].rsplit(' ', 2)[0]
-            elif line == "":
-                message_start = i + 1
-                break
-        message = "\n".join(lines[message_start:])
+        for m in _COMMIT_HEADER_RE.finditer(header):
+            field, value = m.group(1), m.group(2).decode()
+            if field == b"tree":
+                tree_hash = value
+            elif field == b"parent":
+                parent_hashes.append(value)
+            elif field == b"author":
+                author = value.rsplit(' ', 2)[0]
+            else:
+                committer = value.rsplit(' ', 2)[0]
         return cls(tree_hash, parent_hashes, author, committer, message)
 
 
@@ -142,169 +278,585 @@ class Commit(GitObject):
 # ==============================================
 class Repository:
     def __init__(self, path="."):
-        self.path = Path(path).resolve()
-        self.gitdir = self.path / ".gitpy"
-        self.objects = self.gitdir / "objects"
-        self.refs = self.gitdir / "refs"
-        self.head = self.gitdir / "HEAD"
-        self.index = self.gitdir / "index"
-        self.head_dir = self.refs / "heads"
+        # plain strings rather than Path objects: every command joins and
+        # stats many of these, and os.path does it without the object overhead.
+        # Nothing here touches the disk; see path below.
+        self._root = path
+        self.gitdir = os.path.join(path, ".gitpy")
+        self.objects = os.path.join(self.gitdir, "objects")
+        self.refs = os.path.join(self.gitdir, "refs")
+        self.head = os.path.join(self.gitdir, "HEAD")
+        self.index = os.path.join(self.gitdir, "index")
+        self.hashcache = os.path.join(self.gitdir, "hashcache")
+        self.head_dir = os.path.join(self.refs, "heads")
+        # per-branch tree hash sidecars, kept out of refs/heads so they can
+        # never be mistaken for branches
+        self.tree_dir = os.path.join(self.refs, "trees")
+        self._obj_cache = OrderedDict()
+        # mtimes of the index and hash cache files as last loaded, for the
+        # racy-entry checks
+        self._index_mtime_ns = None
+        self._hashcache_mtime_ns = None
+        # object files written since the last flush()
+        self._unsynced = []
+
+    @functools.cached_property
+    def path(self) -> str:
+        # resolving the working directory stats every path component, so it
+        # is done on first use; only staging and checkout need it
+        return os.path.realpath(self._root)
 
     def init(self): 
-        if self.gitdir.exists():
+        if os.path.exists(self.gitdir):
             return False
-        self.gitdir.mkdir()
-        self.objects.mkdir()
-        self.refs.mkdir()
-        self.head_dir.mkdir()
-        self.head.write_text("ref: refs/heads/main\n")
+        os.mkdir(self.gitdir)
+        os.mkdir(self.objects)
+        for i in range(256):
+            os.mkdir(os.path.join(self.objects, f"{i:02x}"))
+        os.mkdir(self.refs)
+        os.mkdir(self.head_dir)
+        os.mkdir(self.tree_dir)
+        self._write_text(self.head, "ref: refs/heads/main\n")
         self.save_index({})
         print("Initialized empty gitpy repository")
         return True
 
-    def load_index(self) -> Dict[str, str]:
-        if not self.index.exists():
+    def load_index(self) -> Dict[str, Dict]:
+        try:
+            with open(self.index, 'rb') as f:
+                self._index_mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+                data = f.read()
+        except FileNotFoundError:
             return {}
+        if data.startswith(INDEX_MAGIC):
+            entry_struct, fields = INDEX_ENTRY, INDEX_FIELDS
+        elif data.startswith(INDEX_MAGIC_V1):
+            entry_struct, fields = INDEX_ENTRY_V1, INDEX_FIELDS_V1
+        else:
+            return self._load_json_index(data)
+
+        index = {}
+        _, count = INDEX_HEADER.unpack_from(data)
+        offset = INDEX_HEADER.size
+        for _ in range(count):
+            path_len, raw_hash, *stat_data = entry_struct.unpack_from(data, offset)
+            offset += entry_struct.size
+            path = data[offset:offset + path_len].decode()
+            offset += path_len
+            entry = dict(zip(fields, stat_data))
+            entry["hash"] = raw_hash.hex()
+            index[path] = entry
+        return index
+
+    @staticmethod
+    def _load_json_index(data: bytes) -> Dict[str, Dict]:
+        # indexes written before the binary format was introduced
         try:
-            return json.loads(self.index.read_text())
-        except json.JSONDecodeError:
+            index = json.loads(data)
+        except (json.JSONDecodeError, UnicodeDecodeError):
             return {}
+        # the oldest ones map path -> hash with no stat data
+        return {path: {"hash": entry} if isinstance(entry, str) else entry
+                for path, entry in index.items()}
 
-    def save_index(self, index: Dict[str, str]):
-        self.index.write_text(json.dumps(index, indent=2))
+    def save_index(self, index: Dict[str, Dict]):
+        paths = [path.encode() for path in index]
+        buf = bytearray(INDEX_HEADER.size + INDEX_ENTRY.size * len(paths) + sum(map(len, paths)))
+        INDEX_HEADER.pack_into(buf, 0, INDEX_MAGIC, len(paths))
+        offset = INDEX_HEADER.size
+        for path, entry in zip(paths, index.values()):
+            INDEX_ENTRY.pack_into(buf, offset, len(path), bytes.fromhex(entry["hash"]),
+                                  entry.get("mtime_ns", 0), entry.get("ctime_ns", 0),
+                                  entry.get("size", 0), entry.get("ino", 0))
+            offset += INDEX_ENTRY.size
+            buf[offset:offset + len(path)] = path
+            offset += len(path)
+        # write beside the index and swap it in, so readers never see a partial index
+        tmp_index = os.path.join(self.gitdir, "index.lock")
+        with open(tmp_index, 'wb') as f:
+            f.write(buf)
+        os.replace(tmp_index, self.index)
+
+    def load_hashcache(self) -> Dict[int, Tuple[int, int, int, int, bytes]]:
+        # Unlike the index this survives commits, so files that have not
+        # changed since any earlier add are never hashed again.
+        try:
+            f = open(self.hashcache, 'rb')
+        except FileNotFoundError:
+            return {}
+        with f:
+            st = os.fstat(f.fileno())
+            self._hashcache_mtime_ns = st.st_mtime_ns
+            if st.st_size < len(HASHCACHE_MAGIC) + HASHCACHE_ENTRY.size:
+                return {}
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                start = len(HASHCACHE_MAGIC)
+                if data[:start] != HASHCACHE_MAGIC:
+                    return {}
+                end = len(data) - (len(data) - start) % HASHCACHE_ENTRY.size
+                view = memoryview(data)
+                try:
+                    return {key: (ino, mtime_ns, ctime_ns, size, raw_hash)
+                            for key, ino, mtime_ns, ctime_ns, size, raw_hash
+                            in HASHCACHE_ENTRY.iter_unpack(view[start:end])}
+                finally:
+                    view.release()
+
+    def save_hashcache(self, hashcache: Dict[int, Tuple[int, int, int, int, bytes]]):
+        # packed before anything is written, then swapped in like the index,
+        # so a failure or interrupt never leaves a truncated cache behind
+        data = HASHCACHE_MAGIC + b''.join([HASHCACHE_ENTRY.pack(key, *record)
+                                           for key, record in hashcache.items()])
+        tmp_hashcache = os.path.join(self.gitdir, "hashcache.lock")
+        with open(tmp_hashcache, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_hashcache, self.hashcache)
+
+    @staticmethod
+    def _read_text(path: str) -> str:
+        # contents of a small text file, or None when it does not exist
+        try:
+            with open(path) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _write_text(path: str, text: str):
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def _object_path(self, obj_hash: str) -> str:
+        return os.path.join(self.objects, obj_hash[:2], obj_hash[2:])
+
+    @staticmethod
+    def _hashcache_key(path: str) -> int:
+        return int.from_bytes(hashlib.blake2b(path.encode(), digest_size=8).digest(), 'little')
+
+    def lookup_hashcache(self, hashcache: Dict, path: str, st: os.stat_result) -> str:
+        # same rules as is_unchanged: ctime must match too, and a record whose
+        # mtime is not older than the cache file itself is racy and ignored
+        record = hashcache.get(self._hashcache_key(path))
+        if (record is not None
+                and record[:4] == (st.st_ino, st.st_mtime_ns, st.st_ctime_ns, st.st_size)
+                and st.st_mtime_ns < self._hashcache_mtime_ns):
+            return record[4].hex()
+        return None
+
+    def remember_hash(self, hashcache: Dict, path: str, st: os.stat_result, blob_hash: str):
+        # one record per path, so stale stat data is replaced rather than accumulated
+        hashcache[self._hashcache_key(path)] = (st.st_ino, st.st_mtime_ns, st.st_ctime_ns,
+                                                st.st_size, bytes.fromhex(blob_hash))
+
+    @staticmethod
+    def index_entry(blob_hash: str, st: os.stat_result) -> Dict:
+        return {"hash": blob_hash, "mtime_ns": st.st_mtime_ns, "ctime_ns": st.st_ctime_ns,
+                "size": st.st_size, "ino": st.st_ino}
+
+    def is_unchanged(self, entry: Dict, st: os.stat_result) -> bool:
+        # Same stat data as when the file was last added -> same blob. ctime
+        # cannot be set from userspace, so a rewrite that restores the old
+        # mtime is still caught. Like git, an entry whose mtime is not older
+        # than the loaded index is racy (the file may have changed again in
+        # the same timestamp tick) and is never trusted.
+        return (entry is not None
+                and entry.get("mtime_ns") == st.st_mtime_ns
+                and entry.get("ctime_ns") == st.st_ctime_ns
+                and entry.get("size") == st.st_size
+                and entry.get("ino") == st.st_ino
+                and self._index_mtime_ns is not None
+                and st.st_mtime_ns < self._index_mtime_ns)
 
     def load_object(self, obj_hash: str) -> GitObject:
-        obj_dir = self.objects / obj_hash[:2]
-        obj_file = obj_dir / obj_hash[2:]
-        if not obj_file.exists():
-            raise Exception(f"Object {obj_hash} does not exist")
-        return GitObject.deserialize(obj_file.read_bytes())
+        # objects are immutable, so cached entries never need invalidating
+        obj = self._obj_cache.get(obj_hash)
+        if obj is not None:
+            self._obj_cache.move_to_end(obj_hash)
+            return obj
+        try:
+            with open(self._object_path(obj_hash), 'rb') as f:
+                obj = _LazyObject(f.read())
+        except FileNotFoundError:
+            raise ValueError(f"Object {obj_hash} does not exist")
+        if obj.size <= OBJECT_CACHE_MAX_OBJECT:
+            self._obj_cache[obj_hash] = obj
+            if len(self._obj_cache) > OBJECT_CACHE_SIZE:
+                self._obj_cache.popitem(last=False)
+        return obj
+
+    def _stream_object_to(self, obj_hash: str, dst_path: str):
+        # Inflate an object straight into dst_path in fixed-size chunks,
+        # dropping the "<type> <len>\0" header, so memory stays bounded.
+        try:
+            src = open(self._object_path(obj_hash), 'rb')
+        except FileNotFoundError:
+            raise ValueError(f"Object {obj_hash} does not exist")
+        header = b''
+        with src, open(dst_path, 'wb') as dst:
+            first = src.read(STREAM_BUFFER_SIZE)
+            decompressor, skip = object_decompressor(first)
+            # keep reading until EOF even if the first read held nothing
+            # beyond the format marker
+            for chunk in chain([first[skip:]], iter(lambda: src.read(STREAM_BUFFER_SIZE), b'')):
+                while chunk:
+                    out = decompressor.decompress(chunk, STREAM_BUFFER_SIZE)
+                    chunk = decompressor.unconsumed_tail
+                    if header is not None:
+                        # the header may straddle chunk boundaries
+                        header += out
+                        null_idx = header.find(b'\0')
+                        if null_idx == -1:
+                            continue
+                        out = header[null_idx + 1:]
+                        header = None
+                    dst.write(out)
+            dst.write(decompressor.flush())
 
     def store_object(self, obj: GitObject) -> str:
         obj_hash = obj.hash()
-        obj_path = self.objects / obj_hash[:2]
-        obj_file = obj_path / obj_hash[2:]
-        if not obj_path.exists():
-            obj_path.mkdir(exist_ok=True)
-        obj_file.write_bytes(obj.serialize())
+        obj_file = self._object_path(obj_hash)
+        # objects are content-addressed, so an existing file already holds these bytes
+        if not os.path.exists(obj_file):
+            self._write_object(obj_file, obj.serialize())
         return obj_hash
 
-    def add_file(self, path):
-        full_path = self.path / path
-        if not full_path.exists():
-            raise Exception(f"File {path} does not exist")
-        content = full_path.read_bytes()
-        blob = Blob(content)
-        blob_hash = self.store_object(blob)
-        index = self.load_index()
-        index[str(path)] = blob_hash
-        self.save_index(index)
+    @staticmethod
+    def _object_tempfile(obj_file: str):
+        # Objects are written next to their final name and renamed into
+        # place, so a crash never leaves a half-written object behind. A plain
+        # exclusive open (rather than tempfile's 0600 files) keeps the usual
+        # umask-based permissions through the rename.
+        tmp_name = f"{obj_file}.{os.urandom(8).hex()}.tmp"
+        try:
+            return open(tmp_name, 'xb')
+        except FileNotFoundError:
+            # repositories initialized before init created every fan-out directory;
+            # a missing objects directory still raises, as outside a repository
+            try:
+                os.mkdir(os.path.dirname(obj_file))
+            except FileExistsError:
+                pass
+            return open(tmp_name, 'xb')
+
+    def _write_object(self, obj_file: str, data: bytes):
+        with self._object_tempfile(obj_file) as tmp:
+            tmp.write(data)
+        os.replace(tmp.name, obj_file)
+        self._unsynced.append(obj_file)
+
+    @staticmethod
+    def _fsync_path(path: str, flags: int = os.O_RDONLY):
+        # Windows flushes only handles opened for writing and cannot open
+        # directories at all; what cannot be synced there is skipped
+        try:
+            fd = os.open(path, flags)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def flush(self):
+        # Make the objects this repository wrote durable, so nothing written
+        # afterwards (index, hash cache, a ref) can point at an object lost
+        # in a crash: fsync each object file, then each fan-out directory
+        # holding one of the renames. add and commit each call this once,
+        # not once per object.
+        written, self._unsynced = self._unsynced, []
+        for obj_file in written:
+            self._fsync_path(obj_file, os.O_RDWR)
+        for obj_dir in {os.path.dirname(obj_file) for obj_file in written}:
+            self._fsync_path(obj_dir)
+
+    def store_file(self, filepath: str) -> str:
+        # Hash and store a file as a blob straight from an mmap of its bytes,
+        # so the content is never copied into Python memory.
+        with open(filepath, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+            view = memoryview(data)
+            try:
+                header = object_header('blob', size)
+                h = hashlib.sha1()
+                h.update(header)
+                h.update(view)
+                obj_hash = h.hexdigest()
+
+                obj_file = self._object_path(obj_hash)
+                if os.path.exists(obj_file):
+                    return obj_hash
+                compressor = new_compressor(1)
+                with self._object_tempfile(obj_file) as tmp:
+                    tmp.write(RAW_OBJECT_MAGIC)
+                    tmp.write(compressor.compress(header))
+                    for i in range(0, size, CHUNK_SIZE):
+                        tmp.write(compressor.compress(view[i:i + CHUNK_SIZE]))
+                    tmp.write(compressor.flush())
+                os.replace(tmp.name, obj_file)
+                self._unsynced.append(obj_file)
+            finally:
+                view.release()
+                if size:
+                    data.close()
+        return obj_hash
+
+    def bulk_store_blobs(self, paths: List[str]) -> Dict[str, str]:
+        # Reader threads fill a bounded queue with file contents while hasher
+        # threads hash, compress and write them; both sides spend most of
+        # their time in I/O or in C code that releases the GIL.
+        import queue
+        from concurrent.futures import ThreadPoolExecutor
+
+        pending = queue.SimpleQueue()
+        for path in paths:
+            pending.put(path)
+        loaded = queue.Queue(maxsize=BULK_QUEUE_SIZE)
+        results = {}
+        errors = []
+
+        def read():
+            while True:
+                try:
+                    path = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    # reading one byte past CHUNK_SIZE tells large files apart
+                    # without an fstat; those go through the streaming path
+                    with open(path, 'rb') as f:
+                        data = f.read(CHUNK_SIZE + 1)
+                    if len(data) > CHUNK_SIZE:
+                        results[path] = self.store_file(path)
+                    else:
+                        loaded.put((path, data))
+                except Exception as e:
+                    errors.append(e)
+
+        def store():
+            while True:
+                item = loaded.get()
+                if item is None:
+                    return
+                path, data = item
+                try:
+                    header = object_header('blob', len(data))
+                    h = hashlib.sha1()
+                    h.update(header)
+                    h.update(data)
+                    obj_hash = h.hexdigest()
+                    obj_file = self._object_path(obj_hash)
+                    if not os.path.exists(obj_file):
+                        self._write_object(obj_file, compress_object(header, data))
+                    results[path] = obj_hash
+                except Exception as e:
+                    errors.append(e)
+
+        # never start more threads than there are files to share out
+        reader_count = min(BULK_READERS, len(paths))
+        hasher_count = min(os.cpu_count() or 1, len(paths))
+        with ThreadPoolExecutor(max_workers=max(reader_count + hasher_count, 1)) as ex:
+            hashers = [ex.submit(store) for _ in range(hasher_count)]
+            for reader in [ex.submit(read) for _ in range(reader_count)]:
+                reader.result()
+            for _ in hashers:
+                loaded.put(None)
+        if errors:
+            raise errors[0]
+        return results
+
+    # add_file and add_directory update the index and hash cache passed in;
+    # add_paths loads and saves both once for the whole command. They
+    # return True when the hash cache changed. A stat the caller already
+    # has is passed in so the path is not stat'ed twice.
+    def add_file(self, path, index: Dict[str, Dict], hashcache: Dict,
+                 st: os.stat_result = None) -> bool:
+        full_path = os.path.join(self.path, path)
+        if st is None:
+            try:
+                st = os.stat(full_path)
+            except FileNotFoundError:
+                raise ValueError(f"File {path} does not exist")
+        entry = index.get(str(path))
+        if self.is_unchanged(entry, st):
+            print(f"{path} is unchanged")
+            return False
+        blob_hash = self.lookup_hashcache(hashcache, str(path), st)
+        stored = blob_hash is None
+        if stored:
+            blob_hash = self.store_file(full_path)
+            self.remember_hash(hashcache, str(path), st, blob_hash)
+        index[str(path)] = self.index_entry(blob_hash, st)
         print(f"Added {path}")
+        return stored
 
-    def add_directory(self, path):
-        fullpath = self.path / path
-        if not fullpath.exists():
-            raise Exception(f"Directory {path} does not exist")
-        if not fullpath.is_dir():
-            raise Exception(f"Path {path} is not a directory")
+    def add_directory(self, path, index: Dict[str, Dict], hashcache: Dict,
+                      st: os.stat_result = None) -> bool:
+        fullpath = os.path.normpath(os.path.join(self.path, path))
+        if st is None:
+            try:
+                st = os.stat(fullpath)
+            except FileNotFoundError:
+                raise ValueError(f"Directory {path} does not exist")
+        if not stat.S_ISDIR(st.st_mode):
+            raise ValueError(f"Path {path} is not a directory")
+        if os.path.commonpath([self.path, fullpath]) != self.path:
+            raise ValueError(f"Path {path} is outside the repository")
 
-        index = self.load_index()
         count = 0
-        for filepath in fullpath.rglob('*'):
-            if filepath.is_file():
-                if ".gitpy" in filepath.parts:
-                    continue
-                blob = Blob(filepath.read_bytes())
-                blob_hash = self.store_object(blob)
-                retpath = filepath.relative_to(self.path)
-                index[str(retpath)] = blob_hash
-                count += 1
-        self.save_index(index)
+        changed = {}
+        files = self._walk_files(fullpath) if ".gitpy" not in fullpath.split(os.sep) else ()
+        for filepath, st in files:
+            count += 1
+            rel_path = os.path.relpath(filepath, self.path)
+            if self.is_unchanged(index.get(rel_path), st):
+                continue
+            blob_hash = self.lookup_hashcache(hashcache, rel_path, st)
+            if blob_hash is not None:
+                index[rel_path] = self.index_entry(blob_hash, st)
+            else:
+                changed[rel_path] = st
+        if not changed:
+            stored = {}
+        elif len(changed) < PARALLEL_ADD_THRESHOLD or (os.cpu_count() or 1) < 2:
+            # with a single CPU a process pool only adds spawn and IPC cost
+            blobs = self.bulk_store_blobs([os.path.join(self.path, rel_path) for rel_path in changed])
+            stored = {rel_path: blobs[os.path.join(self.path, rel_path)] for rel_path in changed}
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            stored = {}
+            with ProcessPoolExecutor(max_workers=os.cpu_count()) as ex:
+                for rel_path, blob_hash, written in ex.map(_hash_and_store, repeat(self.path),
+                                                           changed, chunksize=16):
+                    stored[rel_path] = blob_hash
+                    if written:
+                        self._unsynced.append(self._object_path(blob_hash))
+        for rel_path, blob_hash in stored.items():
+            index[rel_path] = self.index_entry(blob_hash, changed[rel_path])
+            self.remember_hash(hashcache, rel_path, changed[rel_path], blob_hash)
         print(f"Added {count} files from directory {path}")
+        return bool(stored)
+
+    @staticmethod
+    def _walk_files(directory: str):
+        # os.scandir entries carry the file type from the directory read,
+        # so only the stat of each file is an extra syscall
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name != ".gitpy":
+                        yield from Repository._walk_files(entry.path)
+                elif entry.is_file():
+                    yield entry.path, entry.stat()
 
     def add_path(self, path):
-        fullpath = self.path / path
-        if not fullpath.exists():
-            raise Exception(f"Path {path} does not exist")
-        if fullpath.is_file():
-            self.add_file(path)
-        elif fullpath.is_dir():
-            self.add_directory(path)
-        else:
-            raise Exception(f"Path {path} is neither file nor directory")
+        self.add_paths([path])
 
-    def create_tree_from_index(self):
+    def add_paths(self, paths: List[str]):
         index = self.load_index()
+        hashcache = self.load_hashcache()
+        hashcache_changed = False
+        for path in paths:
+            try:
+                st = os.stat(os.path.join(self.path, path))
+            except FileNotFoundError:
+                raise ValueError(f"Path {path} does not exist")
+            if stat.S_ISREG(st.st_mode):
+                hashcache_changed |= self.add_file(path, index, hashcache, st)
+            elif stat.S_ISDIR(st.st_mode):
+                hashcache_changed |= self.add_directory(path, index, hashcache, st)
+            else:
+                raise ValueError(f"Path {path} is neither file nor directory")
+        self.flush()
+        if hashcache_changed:
+            self.save_hashcache(hashcache)
+        self.save_index(index)
+
+    def create_tree_from_index(self, index: Dict[str, Dict] = None):
+        if index is None:
+            index = self.load_index()
         if not index:
             tree = Tree()
             return self.store_object(tree)
 
-        dirs = {}
-        files = {}
+        # Paths under the same directory are contiguous once sorted, so each
+        # directory's tree is written as soon as the walk leaves it and every
+        # tree is serialized exactly once.
+        open_dirs = []
+        open_entries = [[]]
 
-        for filepath, blob_hash in index.items():
-            parts = filepath.split('/')
-            if len(parts) == 1:
-                files[parts[0]] = blob_hash
-            else:
-                dir_name = parts[0]
-                if dir_name not in dirs:
-                    dirs[dir_name] = {}
-                current = dirs[dir_name]
-                for part in parts[1:-1]:
-                    if part not in current:
-                        current[part] = {}
-                    current = current[part]
-                current[parts[-1]] = blob_hash
-
-        def create_tree_recursive(entries_dict: Dict):
-            tree = Tree()
-            for name, blob_hash in entries_dict.items():
-                if isinstance(blob_hash, str):
-                    tree.add_entry('100644', name, blob_hash)
-                elif isinstance(blob_hash, dict):
-                    sub_tree_hash = create_tree_recursive(blob_hash)
-                    tree.add_entry('40000', name, sub_tree_hash)
-            return self.store_object(tree)
+        def close_dir():
+            tree_hash = self.store_object(Tree(open_entries.pop()))
+            open_entries[-1].append(('40000', open_dirs.pop(), tree_hash))
 
-        root_entries = {**files}
-        for dir_name, dir_content in dirs.items():
-            root_entries[dir_name] = dir_content
-        return create_tree_recursive(root_entries)
+        for filepath, entry in sorted(index.items()):
+            *dir_parts, name = filepath.split('/')
+            common = 0
+            while (common < len(open_dirs) and common < len(dir_parts)
+                   and open_dirs[common] == dir_parts[common]):
+                common += 1
+            while len(open_dirs) > common:
+                close_dir()
+            for part in dir_parts[common:]:
+                open_dirs.append(part)
+                open_entries.append([])
+            open_entries[-1].append(('100644', name, entry["hash"]))
+        while open_dirs:
+            close_dir()
+        return self.store_object(Tree(open_entries[0]))
 
     def get_current_branch(self) -> str:
-        if not self.head.exists():
-            return "main"
-        head_content = self.head.read_text().strip()
+        # read directly: outside a repository this is what raises
+        # FileNotFoundError, so callers need no separate .gitpy check
+        with open(self.head) as f:
+            head_content = f.read().strip()
         if head_content.startswith("ref: refs/heads/"):
             return head_content[16:]
         return "HEAD"
 
     def get_branch_commit(self, branch: str) -> str:
-        branch_file = self.head_dir / branch
-        if branch_file.exists():
-            return branch_file.read_text().strip()
-        return None
+        commit_hash = self._read_text(os.path.join(self.head_dir, branch))
+        return commit_hash.strip() if commit_hash is not None else None
 
-    def set_branch_commit(self, branch: str, commit_hash: str):
-        branch_file = self.head_dir / branch
-        branch_file.write_text(commit_hash + "\n")
+    def set_branch_commit(self, branch: str, commit_hash: str, tree_hash: str = None):
+        self._write_text(os.path.join(self.head_dir, branch), commit_hash + "\n")
+        # sidecar caching the commit's tree hash; dropped when unknown so it
+        # never goes stale. Without refs/trees (older repositories, or a
+        # branch name with a missing parent directory) none is kept and
+        # commit reads the tree from the commit instead.
+        tree_file = os.path.join(self.tree_dir, branch)
+        try:
+            if tree_hash:
+                self._write_text(tree_file, tree_hash + "\n")
+            else:
+                os.remove(tree_file)
+        except FileNotFoundError:
+            pass
+
+    def get_branch_tree(self, branch: str) -> str:
+        tree_hash = self._read_text(os.path.join(self.tree_dir, branch))
+        return tree_hash.strip() if tree_hash is not None else None
 
     def commit(self, message: str, author: str = "Gitpy User"):
-        tree_hash = self.create_tree_from_index()
         current_branch = self.get_current_branch()
-        parent_commit = self.get_branch_commit(current_branch)
-        parent_hashes = [parent_commit] if parent_commit else []
-
+        # the index is read once and an empty one never writes a tree
         index = self.load_index()
         if not index:
             print("No changes to commit (Up to date)")
             return
+        tree_hash = self.create_tree_from_index(index)
+        parent_commit = self.get_branch_commit(current_branch)
+        parent_hashes = [parent_commit] if parent_commit else []
 
         if parent_commit:
-            parent_git_commit_obj = self.load_object(parent_commit)
-            parent_commit_data = Commit.from_content(parent_git_commit_obj.content)
-            if tree_hash == parent_commit_data.tree_hash:
+            parent_tree_hash = self.get_branch_tree(current_branch)
+            if parent_tree_hash is None:
+                # no sidecar (older repository), read the tree from the parent commit
+                parent_git_commit_obj = self.load_object(parent_commit)
+                parent_tree_hash = Commit.from_content(parent_git_commit_obj.content).tree_hash
+            if tree_hash == parent_tree_hash:
                 print("No changes to commit (Up to date)")
                 return
 
@@ -316,7 +868,8 @@ class Repository:
             message=message
         )
         commit_hash = self.store_object(commit_obj)
-        self.set_branch_commit(current_branch, commit_hash)
+        self.flush()
+        self.set_branch_commit(current_branch, commit_hash, tree_hash)
         self.save_index({})
         print(f"Committed to {current_branch} with commit {commit_hash}")
         return commit_hash
@@ -339,8 +892,8 @@ class Repository:
             print("could not get files from tree")
         return files
         pass
-    def checkout(self, branch: str, create_branch: bool = False):
-        branch_file = self.head_dir/ branch
+    def checkout(self, branch: str, create_branch: bool = False, assume_clean: bool = False):
+        branch_file = os.path.join(self.head_dir, branch)
         previous_branch_file = self.get_current_branch()
         files_to_clear =set()
             #  Calculate files to clear from previous branch
@@ -356,41 +909,55 @@ class Repository:
         except Exception as e:
             files_to_clear = set()
             pass
-        if not branch_file.exists():
+        if not os.path.exists(branch_file):
             if create_branch:
                 
                 if previous_commit_hash:
-                    self.set_branch_commit(branch, previous_commit_hash)
+                    self.set_branch_commit(branch, previous_commit_hash,
+                                           self.get_branch_tree(previous_branch_file))
                     print(f"Created and switched to new branch {branch}")
                 else:
                     print(f"No commit found for branch {previous_branch_file}")
-                    return
+                    return False
                 # self.head_dir.write_text(f"ref: refs/heads/{branch}\n")
-                self.head.write_text(f"ref: refs/heads/{branch}\n")
+                self._write_text(self.head, f"ref: refs/heads/{branch}\n")
             else:
                 print(f"Branch {branch} does not exist")
                 print(f"use python main.py checkout -b{branch} to create a new branch")
-                return 
-        self.head.write_text(f"ref: refs/heads/{branch}\n")
+                return False
+        self._write_text(self.head, f"ref: refs/heads/{branch}\n")
                 # Clear files from previous branch
-        self.restoring_working_directory(branch,files_to_clear)
+        self.restoring_working_directory(branch,files_to_clear,assume_clean)
         print(f"Switched to branch {branch}")
-    def restoring_working_directory(self,branch:str,files_to_clear:set[str]):
+        return True
+    def restoring_working_directory(self,branch:str,files_to_clear:set[str],assume_clean:bool=False):
         target_commit_hash = self.get_branch_commit(branch)
         if not target_commit_hash:
             print(f"No commit found for branch {branch}")
             return
+        if assume_clean:
+            # The caller guarantees the working tree still matches the previous
+            # commit, so nothing is stat'ed: files the target tree rewrites
+            # anyway are left alone and the rest are removed directly.
+            target_commit = Commit.from_content(self.load_object(target_commit_hash).content)
+            if target_commit.tree_hash:
+                files_to_clear = files_to_clear - self.get_files_from_tree_recursive(target_commit.tree_hash)
+            for rel_path in files_to_clear:
+                try:
+                    os.remove(os.path.join(self.path, rel_path))
+                except FileNotFoundError:
+                    pass
+            files_to_clear = ()
         for rel_path in files_to_clear:
             try:
-                full_path = self.path / rel_path
-                if full_path.exists():
-                    if full_path.is_file():
-                        full_path.unlink()
-                    elif full_path.is_dir():
-                        for sub in full_path.rglob('*'):
-                            if sub.is_file():
-                                sub.unlink()
-                        full_path.rmdir()
+                full_path = os.path.join(self.path, rel_path)
+                if os.path.isfile(full_path):
+                    os.remove(full_path)
+                elif os.path.isdir(full_path):
+                    for dirpath, _, filenames in os.walk(full_path):
+                        for filename in filenames:
+                            os.remove(os.path.join(dirpath, filename))
+                    os.rmdir(full_path)
             except Exception as e:
                 print(f"Could not remove {rel_path}: {e}")
         target_commit_object = self.load_object(target_commit_hash)
@@ -399,21 +966,18 @@ class Repository:
             self.restore_tree(target_commit.tree_hash,self.path)
         self.save_index({})
 
-    def restore_tree(self,tree_hash:str,path:Path):
+    def restore_tree(self,tree_hash:str,path:str):
         
         try:
             tree_object = self.load_object(tree_hash)
             tree = Tree.from_content(tree_object.content)
 
             for mode, name, obj_hash in tree.entries:
-                file_path = path/name
+                file_path = os.path.join(path, name)
                 if mode.startswith('100'):
-                    blob_obj = self.load_object(obj_hash)
-                    blob = Blob(blob_obj.content)
-                    file_path.write_bytes(blob.content)
-                    pass
+                    self._stream_object_to(obj_hash, file_path)
                 elif mode.startswith('400'):
-                    file_path.mkdir(exist_ok=True)
+                    os.makedirs(file_path, exist_ok=True)
                     subtree_files = self.restore_tree(obj_hash,file_path)
             pass
         except Exception as e:
@@ -422,59 +986,226 @@ class Repository:
             
         
 
+# ==============================================
+# Worker Helpers
+# ==============================================
+def _hash_and_store(repo_root: str, rel_path: str) -> Tuple[str, str, bool]:
+    # module level so ProcessPoolExecutor can pickle it; also reports whether
+    # the object was newly written, so the parent process can fsync it
+    repo = Repository(repo_root)
+    blob_hash = repo.store_file(os.path.join(repo_root, rel_path))
+    return rel_path, blob_hash, bool(repo._unsynced)
+
+
 # ==============================================
 # CLI Entry Point
 # ==============================================
 
 
-def main():
-    parser = argparse.ArgumentParser(description="gitpy")  
-    subparsers = parser.add_subparsers(dest='command')
+# Each handler opens the repository itself, so parsing errors and --help
+# never touch the disk; the thread/process pool modules are only imported
+# by the code paths that store objects. There is no upfront .gitpy check:
+# outside a repository the command's first read or write of .gitpy raises
+# FileNotFoundError, which main() reports.
+def _cmd_init(args) -> int:
+    repo = Repository()
+    if not repo.init():
+        print("Repository already exists")
+        return 1
+    return 0
 
-    # init command
-    subparsers.add_parser('init', help='Initialize a new gitpy repository')
 
-    # add command
-    add_parser = subparsers.add_parser('add', help='Add files to gitpy repository')
-    add_parser.add_argument("paths", nargs='+', help="Files or directories to add")
+def _cmd_add(args) -> int:
+    Repository().add_paths(args.paths)
+    return 0
 
-    # commit command
-    commit_parser = subparsers.add_parser('commit', help='Commit changes')
-    commit_parser.add_argument("-m", "--message", required=True, help="Commit message")
 
-    #checkout Command
+def _cmd_commit(args) -> int:
+    # like git, having nothing to commit is a failure
+    return 0 if Repository().commit(args.message, "Gitpy User") else 1
 
-    checkout_parser = subparsers.add_parser('checkout', help='Checkout a commit')
-    checkout_parser.add_argument("branch", help="Branch or commit to checkout")
-    checkout_parser.add_argument("-b","--create-branch",action="store_true",help="Create a new branch")
 
-    args = parser.parse_args()
-    if not args.command:
-        parser.print_help()
-        return
+def _cmd_checkout(args) -> int:
+    return 0 if Repository().checkout(args.branch, args.create_branch, args.assume_clean) else 1
 
-    repo = Repository()
+
+def _cmd_help(args) -> int:
+    print(_STATIC_HELP % {"prog": os.path.basename(sys.argv[0])})
+    return 1
+
+
+COMMANDS: Dict[str, Callable[..., int]] = {
+    "init": _cmd_init,
+    "add": _cmd_add,
+    "commit": _cmd_commit,
+    "checkout": _cmd_checkout,
+}
+
+
+# one-line summaries listed by `gitpy --help`
+COMMAND_HELP = {
+    "init": "Initialize a new gitpy repository",
+    "add": "Add files to gitpy repository",
+    "commit": "Commit changes",
+    "checkout": "Checkout a commit",
+}
+
+_COMMAND_METAVAR = "{" + ",".join(COMMAND_HELP) + "}"
+_COMMANDS_EPILOG = "commands:\n" + "\n".join(f"  {name:<22}{text}" for name, text in COMMAND_HELP.items())
+
+# What argparse prints for a bare invocation, kept as a string so that
+# case never imports argparse
+_STATIC_HELP = (
+    "usage: %(prog)s [-h] [" + _COMMAND_METAVAR + "]\n"
+    "\n"
+    "gitpy\n"
+    "\n"
+    "positional arguments:\n"
+    "  " + _COMMAND_METAVAR + "\n"
+    "                        Command to run\n"
+    "\n"
+    "options:\n"
+    "  -h, --help            show this help message and exit\n"
+    "\n" + _COMMANDS_EPILOG
+)
+
+
+# Both parsers are built at most once per process, so calling main()
+# repeatedly in-process (tests, embedding) reuses them. Help texts are only
+# attached when -h/--help was given; usage and error messages never show them.
+@functools.cache
+def _get_parser(with_help: bool = True) -> 'argparse.ArgumentParser':
+    # phase 1: only the command name; everything after it is left for the
+    # command's own parser
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="gitpy" if with_help else None,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=_COMMANDS_EPILOG if with_help else None)
+    parser.add_argument("command", nargs='?', choices=COMMAND_HELP, metavar=_COMMAND_METAVAR,
+                        help="Command to run" if with_help else None)
+    parser.add_argument("args", nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    return parser
+
+
+@functools.cache
+def _get_command_parser(prog: str, command: str, with_help: bool = True) -> 'argparse.ArgumentParser':
+    # phase 2: build the arguments of the matched command only
+    import argparse
+
+    def text(help_text):
+        return help_text if with_help else None
+
+    parser = argparse.ArgumentParser(prog=f"{prog} {command}", description=text(COMMAND_HELP[command]))
+    if command == "add":
+        parser.add_argument("paths", nargs='+', help=text("Files or directories to add"))
+    elif command == "commit":
+        parser.add_argument("-m", "--message", required=True, help=text("Commit message"))
+    elif command == "checkout":
+        parser.add_argument("branch", help=text("Branch or commit to checkout"))
+        parser.add_argument("-b","--create-branch",action="store_true",help=text("Create a new branch"))
+        parser.add_argument("--assume-clean", action="store_true",
+                            help=text("Trust that the working tree matches the current commit "
+                                      "and skip checking files before replacing them"))
+    return parser
+
+
+# The fast parsers below cover well-formed invocations without importing
+# argparse. They return None for anything else (help, abbreviations,
+# errors), and argparse then handles it with its usual messages.
+def _parse_init(argv: List[str]):
+    return SimpleNamespace(command="init") if not argv else None
+
+
+def _parse_add(argv: List[str]):
+    if not argv or any(arg.startswith('-') for arg in argv):
+        return None
+    return SimpleNamespace(command="add", paths=argv)
+
+
+def _parse_commit(argv: List[str]):
+    message = None
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg in ("-m", "--message") and i + 1 < len(argv) and not argv[i + 1].startswith('-'):
+            message = argv[i + 1]
+            i += 2
+        elif arg.startswith("--message="):
+            message = arg[len("--message="):]
+            i += 1
+        else:
+            return None
+    return SimpleNamespace(command="commit", message=message) if message is not None else None
+
+
+def _parse_checkout(argv: List[str]):
+    branch = None
+    create_branch = False
+    assume_clean = False
+    for arg in argv:
+        if arg in ("-b", "--create-branch"):
+            create_branch = True
+        elif arg == "--assume-clean":
+            assume_clean = True
+        elif arg.startswith('-') or branch is not None:
+            return None
+        else:
+            branch = arg
+    if branch is None:
+        return None
+    return SimpleNamespace(command="checkout", branch=branch, create_branch=create_branch,
+                           assume_clean=assume_clean)
+
+
+_FAST_PARSERS = {
+    "init": _parse_init,
+    "add": _parse_add,
+    "commit": _parse_commit,
+    "checkout": _parse_checkout,
+}
+
+
+def _parse_args(argv: List[str]):
+    if not argv:
+        # bare invocation, dispatched to _cmd_help
+        return SimpleNamespace(command=None)
+    with_help = "-h" in argv or "--help" in argv
+    fast = _FAST_PARSERS.get(argv[0])
+    if fast is not None and not with_help:
+        args = fast(argv[1:])
+        if args is not None:
+            return args
+
+    parser = _get_parser(with_help)
+    phase1 = parser.parse_args(argv)
+    if phase1.command is None:
+        # only options were given (e.g. "--"); treated like a bare invocation
+        return phase1
+    args = _get_command_parser(parser.prog, phase1.command, with_help).parse_args(phase1.args)
+    args.command = phase1.command
+    return args
+
+
+# Set GITPY_DEBUG to let errors propagate with their full traceback
+# instead of the one-line messages below, e.g. when profiling.
+_DEBUG = os.environ.get("GITPY_DEBUG")
+
+
+# Exit codes: 0 on success, 1 when the command fails or has nothing to do,
+# 2 for usage errors (reported by argparse).
+def main():
+    args = _parse_args(sys.argv[1:])
+    handler = COMMANDS.get(args.command, _cmd_help)
+    if _DEBUG:
+        sys.exit(handler(args))
     try:
-        if args.command == "init":
-            if not repo.init():
-                print("Repository already exists")
-        elif args.command == "add":
-            if not repo.gitdir.exists():
-                print("Not a gitpy repository")
-                return
-            for path in args.paths:
-                repo.add_path(path)
-        elif args.command == "commit":
-            if not repo.gitdir.exists():
-                print("Not a gitpy repository")
-                return
-            repo.commit(args.message, "Gitpy User")
-        elif args.command == "checkout":
-            if not repo.gitdir.exists():
-                print("Not a gitpy repository")
-                return
-            repo.checkout(args.branch, args.create_branch)
-    except Exception as e:
+        sys.exit(handler(args))
+    except FileNotFoundError as e:
+        # only now is .gitpy itself checked, so the common path never pays for it
+        print(f"Error: {e}" if os.path.isdir(".gitpy") else "Not a gitpy repository")
+        sys.exit(1)
+    except (OSError, ValueError) as e:
         print(f"Error: {e}")
         sys.exit(1)
 